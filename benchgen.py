@@ -12,8 +12,20 @@
 # ----------------------------------------------------------------------------
 # Imports
 # ----------------------------------------------------------------------------
-import math
-import json
+import os
+import re
+import shutil
+import hashlib
+import tempfile
+import itertools
+from dataclasses import dataclass
+from functools import lru_cache
+
+# Prefer orjson for parsing module descriptions if it's installed.
+try:
+    from orjson import loads as json_loads
+except ImportError:
+    from json import loads as json_loads
 
 # Command line handling.
 import sys
@@ -23,53 +35,55 @@ import argparse
 # ----------------------------------------------------------------------------
 # Template
 # ----------------------------------------------------------------------------
-template_bench = """// Testbench for module '{module_name}'.
+# Uses string.Template syntax: placeholders are ${name}, and SystemVerilog
+# system tasks like $write must be escaped as $$write.
+template_bench = """// Testbench for module '${module_name}'.
 // WARNING: This file is auto-generated. IF EDITING MANUALLY, YOUR CHANGES MAY BE OVERWRITTEN.
 // To generate a test bench like this one, see the "Benchgen" project on Github.
 //   https://github.com/philipaconrad/benchgen
 
-module testbench_{module_name};
+module testbench_${module_name};
 
     // Function for displaying a test vector like it appears in the source.
     // Cite: https://www.verificationguide.com/p/systemverilog-functions.html (function syntax)
-    function void display_vector(input [{vec_hi_idx}:{vec_lo_idx}] vec);
+    function void display_vector(input [${vec_hi_idx}:${vec_lo_idx}] vec);
         begin
             // Print bit slices back with the '_' formatting.
             // Cite: https://electronics.stackexchange.com/a/50828
-            $write("{vec_format_str}",
-{vec_format_params});
+            $$write("${vec_format_str}",
+${vec_format_params});
         end
     endfunction
 
     // Input declarations.
-{input_decls}
+${input_decls}
 
     // Testbench variables.
-    logic [{vec_hi_idx}:{vec_lo_idx}] vectors [999:0]; // 1e3 test vectors
-    logic [{vec_hi_idx}:{vec_lo_idx}] current;         // Current test vector
+    logic [${vec_hi_idx}:${vec_lo_idx}] vectors [999:0]; // 1e3 test vectors
+    logic [${vec_hi_idx}:${vec_lo_idx}] current;         // Current test vector
     logic [31:0] i;                // Vector subscript
     logic [3:0] enable;            // Test vector enable
     logic [31:0] error;            // Error counter
 
     initial begin
-{initial_begin_inputs}
+${initial_begin_inputs}
         i     = 0;
         error = 0;
     end
 
     // Instantiate device under test.
-    {module_name} dut ({dut_inputs});
+    ${module_name} dut (${dut_inputs});
 
     initial begin
         // Load test vectors from disk.
-        $readmemh("vectors_{module_name}.dat", vectors);
+        $$readmemh("vectors_${module_name}.dat", vectors);
 
         for (i = 0; i < 1000; i = i + 1) begin
             current = vectors[i];
 
             // Pull out enable, ... signals to stimulate the DUT.
-{enable_stimulate_block}
-{dut_stimulate_block}
+${enable_stimulate_block}
+${dut_stimulate_block}
 
             // Check to see if this test vector is used or not.
             // Vectors in-use always start with 1111.
@@ -78,64 +92,108 @@ module testbench_{module_name};
                 #10;
 
                 // Check the result.
-                if ({output_check_expr}) begin
+                if (${output_check_expr}) begin
                     error += 1;
-                    $write("Vector failed at index: %4d  ", i);
+                    $$write("Vector failed at index: %4d  ", i);
                     display_vector(current);
-                    $display(""); // Newline at the end.
+                    $$display(""); // Newline at the end.
                 end
             end
             if (enable === 4'bx) begin
-                $display("%4d tests completed with %4d errors", i, error);
-                $stop();
+                $$display("%4d tests completed with %4d errors", i, error);
+                $$stop();
             end
         end
 
         // Tell the simulator we're done.
-        $stop();
+        $$stop();
     end
 
 endmodule"""
 
+# Split once at import into alternating literal text and placeholder names
+# (even indices are literals, odd indices are names), so the bench can be
+# streamed to the output file section by section.
+template_bench_chunks = re.split(r"\$\{(\w+)\}", template_bench)
+template_bench_chunks[0::2] = [x.replace("$$", "$") for x in template_bench_chunks[0::2]]
+
+
+# Indentation levels used by the generated code.
+INDENT_4 = " " * 4
+INDENT_8 = " " * 8
+INDENT_12 = " " * 12
+INDENT_19 = " " * 19  # Lines up with the arguments of $write(...).
+
+
+# ----------------------------------------------------------------------------
+# Parameter metadata
+# ----------------------------------------------------------------------------
+
+# Module parameters, stored as parallel lists (one entry per parameter, in
+# vector order) rather than as a list of dictionaries.
+@dataclass
+class Params:
+    names: list
+    hi: list
+    lo: list
+    io: list
+    # Name each field is unpacked into when stimulating the DUT: inputs
+    # drive the DUT directly, outputs go into their expected-value "_e"
+    # variables.
+    emit_names: list
+
+
+# Takes the "parameters" list of dictionaries from a module description.
+def params_from_json(parameters):
+    params = Params(names=[], hi=[], lo=[], io=[], emit_names=[])
+    for p in parameters:
+        name = p["name"]
+        io_type = p["io_type"]
+        params.names.append(name)
+        params.hi.append(p["idx_hi"])
+        params.lo.append(p["idx_lo"])
+        params.io.append(io_type)
+        params.emit_names.append(name if io_type == "input" else name + "_e")
+    return params
+
 
 # ----------------------------------------------------------------------------
 # Utility functions
 # ----------------------------------------------------------------------------
 
-# Cite: https://stackoverflow.com/a/21101086
+# Rounds x up to the next multiple of base, using integer math only.
+# The width helpers are pure, so results are cached across calls for
+# callers generating many test benches in one process.
+@lru_cache(maxsize=1024)
 def round_to_8(x, base=8):
-    return int(base * math.ceil(float(x) / base))
+    return (x + base - 1) // base * base
 
 
+@lru_cache(maxsize=1024)
 def compute_field_bit_width(idx_hi, idx_lo):
     return (idx_hi+1) - idx_lo
 
 
+@lru_cache(maxsize=1024)
 def compute_field_bit_width_hex(idx_hi, idx_lo):
     return round_to_8(compute_field_bit_width(idx_hi, idx_lo), base=4) // 4
 
 
 def generate_vector_format_str(field_lengths_hex):
     # The enable flag is always concatenated to the front.
-    out = "%1h"
-    for length in field_lengths_hex:
-        out += "_%0{}h".format(length)
-    return out
+    return "%1h" + "".join(f"_%0{length}h" for length in field_lengths_hex)
 
 
 # Used to generate the exact slice indices for pulling out test vector parts.
 def generate_bit_slice_indices(field_lengths_hex, exact_bit_width_tuples):
-    out = []
     field_lengths_hexbits = [x * 4 for x in field_lengths_hex]
     top = sum(field_lengths_hexbits)
-    for (hex_length, (idx_hi, idx_lo)) in zip(field_lengths_hexbits,
-                                              exact_bit_width_tuples):
-        width = compute_field_bit_width(idx_hi, idx_lo)
-        out_lo = (top - hex_length)
-        out_hi = (out_lo + width) - 1
-        out.append((out_hi, out_lo))
-        top -= hex_length  # Skip to next field in the vector.
-    return out
+    # Each field's low index is the vector width minus every field up to
+    # and including it.
+    # A field's high index is its low index plus its exact width, less one.
+    out_lo = [top - used for used in itertools.accumulate(field_lengths_hexbits)]
+    return [(lo + (idx_hi - idx_lo), lo)
+            for (lo, (idx_hi, idx_lo)) in zip(out_lo, exact_bit_width_tuples)]
 
 
 # ----------------------------------------------------------------------------
@@ -143,81 +201,153 @@ def generate_bit_slice_indices(field_lengths_hex, exact_bit_width_tuples):
 # ----------------------------------------------------------------------------
 
 def codegen_format_params(slice_index_tuples):
-    out = ""
-    i = 0
-    len_tuples = len(slice_index_tuples)
+    lines = []
     for idx_hi, idx_lo in slice_index_tuples:
-        if i > 0:
-            out += "\n"  # No newline before first line.
-        out += (" " * 19) + "vec[{idx_hi}:{idx_lo}]".format(idx_hi=idx_hi,
-                                                            idx_lo=idx_lo)
-        i += 1
-        if i < len_tuples:
-            out += ","  # No comma after last line.
-    return out
-
-
-# Takes a list of dictionaries.
-def codegen_input_decls(variables_list):
-    out = ""
+        lines.append(INDENT_19 + f"vec[{idx_hi}:{idx_lo}]")
+    # No comma after last line, no newline before first line.
+    return ",\n".join(lines)
+
+
+# Everything about the test vector layout depends only on the parameter
+# widths, not on their names, so it's cached per shape. Callers generating
+# benches for many modules with the same widths only pay for it once.
+# Takes a tuple of (idx_hi, idx_lo) tuples, in vector order.
+@lru_cache(maxsize=128)
+def codegen_vector_layout(parameter_widths):
+    parameter_hex_widths = [compute_field_bit_width_hex(idx_hi, idx_lo)
+                            for (idx_hi, idx_lo) in parameter_widths]
+    vec_hi_idx = (sum(parameter_hex_widths) * 4 + 4) - 1  # 4 bits for enable flag.
+    vec_format_str = generate_vector_format_str(parameter_hex_widths)
+    vec_bit_slices = generate_bit_slice_indices(parameter_hex_widths, parameter_widths)
+    # The enable flag's slice always comes first.
+    vec_format_params = codegen_format_params(
+        itertools.chain([(vec_hi_idx, vec_hi_idx - 3)], vec_bit_slices))
+    return vec_hi_idx, vec_format_str, vec_format_params, tuple(vec_bit_slices)
+
+
+def codegen_input_decls(params):
+    inputs = [i for i, io_type in enumerate(params.io) if io_type == "input"]
+    outputs = [i for i, io_type in enumerate(params.io) if io_type == "output"]
+    names, his, los = params.names, params.hi, params.lo
+    parts = []
     # Put inputs together.
-    out += "\n    // Inputs.\n"
-    for v in variables_list:
-        if v["io_type"] == "input":
-            out += (" " * 4)  # Indentation level.
-            out += "logic [{idx_hi}:{idx_lo}] {name};".format(idx_hi=v["idx_hi"], idx_lo=v["idx_lo"], name=v["name"])
-            out += "\n"
+    parts.append("\n    // Inputs.\n")
+    for i in inputs:
+        parts.append(INDENT_4)
+        parts.append(f"logic [{his[i]}:{los[i]}] {names[i]};\n")
     # Put outputs together.
-    out += "\n    // Outputs.\n"
-    for v in variables_list:
-        if v["io_type"] == "output":
-            out += (" " * 4)  # Indentation level.
-            out += "logic [{idx_hi}:{idx_lo}] {name};".format(idx_hi=v["idx_hi"], idx_lo=v["idx_lo"], name=v["name"])
-            out += "\n"
+    parts.append("\n    // Outputs.\n")
+    for i in outputs:
+        parts.append(INDENT_4)
+        parts.append(f"logic [{his[i]}:{los[i]}] {names[i]};\n")
     # Put expected outputs together.
-    out += "\n    // Expected Outputs.\n"
-    for v in variables_list:
-        if v["io_type"] == "output":
-            out += (" " * 4)  # Indentation level.
-            out += "logic [{idx_hi}:{idx_lo}] {name}_e;".format(idx_hi=v["idx_hi"], idx_lo=v["idx_lo"], name=v["name"])
-            out += "\n"
-    return out
-
-
-def codegen_initial_begin_decls(variables_list):
-    out = ""
-    max_name_length = max([len(v["name"]) for v in variables_list])
-    for v in variables_list:
-        if v["io_type"] == "input":
-            out += (" " * 8)
-            out += ("{:" + str(max_name_length) + "} = 0;").format(v["name"])
-            out += "\n"
-    return out
-
-
-def codegen_dut_stimulate_block(variables_list, bit_slices_list):
-    out = ""
-    max_name_length = max([len(v["name"]) for v in variables_list]) + 2
-    for (v, (idx_hi, idx_lo)) in zip(variables_list, bit_slices_list):
-        out += (" " * 12)  # Indentation level.
-        if v["io_type"] == "input":
-            out += "{:{width}} = current[{idx_hi}:{idx_lo}];".format(v["name"], width=max_name_length, idx_hi=idx_hi, idx_lo=idx_lo)
-        elif v["io_type"] == "output":
-            out += "{:{width}} = current[{idx_hi}:{idx_lo}];".format(v["name"] + "_e", width=max_name_length, idx_hi=idx_hi, idx_lo=idx_lo)
-        out += "\n"
-    return out
-
-
-def codegen_output_check_expr(variables_list):
-    out = ""
-    i = 0
-    for v in variables_list:
-        if i > 0:
-            out += " || "
-        if v["io_type"] == "output":
-            out += "{name} != {name}_e".format(name=v["name"])
-            i += 1
-    return out
+    parts.append("\n    // Expected Outputs.\n")
+    for i in outputs:
+        parts.append(INDENT_4)
+        parts.append(f"logic [{his[i]}:{los[i]}] {names[i]}_e;\n")
+    return "".join(parts)
+
+
+def codegen_initial_begin_decls(params, max_name_length=None):
+    parts = []
+    if max_name_length is None:
+        max_name_length = max([len(name) for name in params.names])
+    for name, io_type in zip(params.names, params.io):
+        if io_type == "input":
+            parts.append(f"{INDENT_8}{name.ljust(max_name_length)} = 0;\n")
+    return "".join(parts)
+
+
+def codegen_dut_stimulate_block(params, bit_slices_list, max_name_length=None):
+    parts = []
+    if max_name_length is None:
+        max_name_length = max([len(name) for name in params.names])
+    max_name_length += 2  # Room for the "_e" suffix on expected outputs.
+    # Fields must stay in vector order, so this one can't be partitioned.
+    for (emit_name, (idx_hi, idx_lo)) in zip(params.emit_names, bit_slices_list):
+        padded = emit_name.ljust(max_name_length)
+        parts.append(f"{INDENT_12}{padded} = current[{idx_hi}:{idx_lo}];\n")
+    return "".join(parts)
+
+
+def codegen_output_check_expr(params):
+    # Only outputs take part, so separators only ever go between outputs.
+    return " || ".join(f"{name} != {name}_e"
+                       for name, io_type in zip(params.names, params.io)
+                       if io_type == "output")
+
+
+def write_bench(outfile, **fields):
+    for i, chunk in enumerate(template_bench_chunks):
+        if i % 2 == 0:
+            outfile.write(chunk)
+        else:
+            outfile.write(str(fields[chunk]))
+    outfile.write("\n")
+
+
+def generate_bench(outfile, j):
+    # Build useful variables for later use in the template.
+    module_name = j["module_name"]
+
+    params = params_from_json(j["parameters"])
+    max_name_length = max(len(x) for x in params.names)
+
+    vec_hi_idx, vec_format_str, vec_format_params, vec_bit_slices = \
+        codegen_vector_layout(tuple(zip(params.hi, params.lo)))
+    vec_lo_idx = 0
+
+    write_bench(outfile,
+                module_name=module_name,
+                vec_format_str=vec_format_str,
+                vec_format_params=vec_format_params,
+                vec_hi_idx=vec_hi_idx,
+                vec_lo_idx=vec_lo_idx,
+                input_decls=codegen_input_decls(params),
+                initial_begin_inputs=codegen_initial_begin_decls(params, max_name_length),
+                dut_inputs=", ".join(params.names),
+                enable_stimulate_block=INDENT_12 + "enable = current[{}:{}];\n".format(vec_hi_idx, vec_hi_idx-3),
+                dut_stimulate_block=codegen_dut_stimulate_block(params, vec_bit_slices, max_name_length),
+                output_check_expr=codegen_output_check_expr(params))
+
+
+# ----------------------------------------------------------------------------
+# Output cache
+# ----------------------------------------------------------------------------
+
+def cache_dir():
+    base = os.environ.get("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache")
+    return os.path.join(base, "benchgen")
+
+
+# The key covers this script as well as the input, so editing benchgen
+# never serves a test bench generated by an older version.
+def cache_path_for(text):
+    h = hashlib.sha256()
+    with open(os.path.abspath(__file__), "rb") as f:
+        h.update(f.read())
+    h.update(text)
+    return os.path.join(cache_dir(), h.hexdigest() + ".sv")
+
+
+# Generates the test bench into the cache, then copies it to outfile.
+# Falls back to writing outfile directly if the cache isn't writable.
+def generate_bench_cached(outfile, j, cache_path):
+    try:
+        os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(cache_path), suffix=".tmp")
+        try:
+            with os.fdopen(fd, "w") as f:
+                generate_bench(f, j)
+            os.replace(tmp_path, cache_path)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+    except OSError:
+        generate_bench(outfile, j)
+        return
+    with open(cache_path) as f:
+        shutil.copyfileobj(f, outfile)
 
 
 # ----------------------------------------------------------------------------
@@ -231,46 +361,23 @@ if __name__ == '__main__':
                         default=sys.stdin)
     parser.add_argument('outfile', nargs='?', type=argparse.FileType('w'),
                         default=sys.stdout)
+    parser.add_argument('--no-cache', action='store_true',
+                        help="don't read or write the output cache")
 
     # Parse command line args.
     args = parser.parse_args()
 
-    text = args.infile.read()
-    j = json.loads(text)
-
-    # Build useful variables for later use in the template.
-    module_name = j["module_name"]
-
-    parameters = j["parameters"]
-    parameter_names = [x["name"] for x in j["parameters"]]
-    parameter_widths = [(x["idx_hi"], x["idx_lo"]) for x in j["parameters"]]
-    parameter_hex_widths = [compute_field_bit_width_hex(idx_hi, idx_lo)
-                            for (idx_hi, idx_lo) in parameter_widths]
-    parameter_hex_bit_widths = [x * 4 for x in parameter_hex_widths]
-
-    vec_hi_idx = (sum(parameter_hex_bit_widths) + 4) - 1  # 4 bits for enable flag.
-    vec_lo_idx = 0
-    vec_format_str = generate_vector_format_str(parameter_hex_widths)
-    vec_bit_slices = generate_bit_slice_indices(parameter_hex_widths, parameter_widths)
-
-    inputs = [x for x in j["parameters"] if x["type"] == "input"]
-    input_names = [x["name"] for x in inputs]
-
-    outputs = [x for x in j["parameters"] if x["type"] == "output"]
-    output_names = [x["name"] for x in outputs]
+    # Both parsers accept raw bytes, which skips a decode step.
+    text = args.infile.buffer.read()
 
-    # Print the filled-in template to the specified file.
+    # Write the filled-in template to the specified file.
     # Default: sys.stdout
-    print(template_bench.format(
-              module_name=module_name,
-              vec_format_str=vec_format_str,
-              vec_format_params=codegen_format_params([(vec_hi_idx, vec_hi_idx - 3)] + vec_bit_slices),
-              vec_hi_idx=vec_hi_idx,
-              vec_lo_idx=vec_lo_idx,
-              input_decls=codegen_input_decls(parameters),
-              initial_begin_inputs=codegen_initial_begin_decls(parameters),
-              dut_inputs=", ".join([v["name"] for v in parameters]),
-              enable_stimulate_block="            enable = current[{}:{}];\n".format(vec_hi_idx, vec_hi_idx-3),
-              dut_stimulate_block=codegen_dut_stimulate_block(parameters, vec_bit_slices),
-              output_check_expr=codegen_output_check_expr(parameters),
-          ), file=args.outfile)
+    if args.no_cache:
+        generate_bench(args.outfile, json_loads(text))
+    else:
+        cache_path = cache_path_for(text)
+        if os.path.isfile(cache_path):
+            with open(cache_path) as f:
+                shutil.copyfileobj(f, args.outfile)
+        else:
+            generate_bench_cached(args.outfile, json_loads(text), cache_path)